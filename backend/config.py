@@ -1,5 +1,9 @@
 import os
+import queue
+import atexit
 import logging
+import logging.handlers
+from functools import lru_cache
 from pathlib import Path
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
@@ -11,14 +15,20 @@ def setup_logging():
     log_format = "%(asctime)s - %(levelname)-8s - %(name)-25s - %(message)s"
     date_format = "%Y-%m-%d %H:%M:%S"
     
-    logging.basicConfig(
-        level=logging.INFO,
-        format=log_format,
-        datefmt=date_format,
-        handlers=[
-            logging.StreamHandler(),
-        ]
-    )
+    # Запись в stdout делает фоновый поток, запросы только кладут запись в очередь
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(log_format, date_format))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    # Форматирует только stream_handler; basicConfig не используем - он навесил бы
+    # свой формат на queue_handler, и префикс в логе задвоился бы
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    if not root.handlers:
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
     
     # Отключаем шум от сторонних библиотек
     logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -51,7 +61,7 @@ class Settings(BaseSettings):
     api_port: int = 8000
     
     # History Configuration
-    history_file: str = "history.json"
+    history_file: str = "history.jsonl"
     max_history_items: int = 10
     
     # Parser Configuration (Playwright)
@@ -66,10 +76,14 @@ class Settings(BaseSettings):
         env_file = ".env"
         extra = "ignore"
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Единственный экземпляр настроек на процесс"""
+    return Settings()
 
-# Логирование при запуске
-if __name__ != "__main__":
+# Баннер при запуске (только по запросу, чтобы не шуметь при каждом импорте)
+if os.getenv("CM_STARTUP_BANNER") == "1":
+    settings = get_settings()
     logger.info("=" * 60)
     logger.info("🚀 CompetitionMonitor - Инициализация конфигурации")
     logger.info("=" * 60)
@@ -1,12 +1,13 @@
 import os
 import io
+import asyncio
 import base64
 import logging
 
+import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, File, Form
-from openai import OpenAI
-from PIL import Image
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.responses import ORJSONResponse
 
 # ================= Настройка окружения и логирования =================
 
@@ -17,12 +18,32 @@ logger = logging.getLogger(__name__)
 
 # ================= Инициализация FastAPI и OpenAI клиента ============
 
-app = FastAPI(title="Мультимодальный Анализатор ДЗ Модуль 4")
+app = FastAPI(title="Мультимодальный Анализатор ДЗ Модуль 4", default_response_class=ORJSONResponse)
 
-client = OpenAI(
-    api_key=os.getenv("OPENAI_PROXY_API_KEY"),
-    base_url=os.getenv("OPENAI_PROXY_BASE_URL", "https://api.openai-proxy.ru/v1")
-)
+_client = None
+
+
+def get_client():
+    """Создаёт OpenAI клиент при первом обращении (SDK тяжёлый на импорт)"""
+    global _client
+    if _client is None:
+        from openai import OpenAI
+
+        _client = OpenAI(
+            api_key=os.getenv("OPENAI_PROXY_API_KEY"),
+            base_url=os.getenv("OPENAI_PROXY_BASE_URL", "https://api.openai-proxy.ru/v1"),
+            # Один пул соединений на процесс: keep-alive + HTTP/2 к прокси
+            http_client=httpx.Client(
+                http2=True,
+                timeout=60.0,
+                limits=httpx.Limits(max_keepalive_connections=10)
+            )
+        )
+    return _client
+
+SUPPORTED_IMAGE_TYPES = ("image/png", "image/jpeg", "image/webp")
+MAX_UPLOAD = 5 * 1024 * 1024
+UPLOAD_CHUNK = 64 * 1024
 
 # ================= Маршруты ==========================================
 
@@ -36,18 +57,35 @@ async def analyze_image(
     file: UploadFile = File(..., description="Загрузи изображение"),
     prompt: str = Form("Опиши изображение подробно на русском", description="Твой промпт")
 ):
-    try:
-        # 1. Читаем файл
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+    if file.size is not None and file.size > MAX_UPLOAD:
+        raise HTTPException(status_code=413, detail="Файл слишком большой")
 
-        # 2. Перекодируем в PNG и Base64 для Vision
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    try:
+        # 1. Читаем файл кусками, не выходя за лимит
+        contents = bytearray()
+        while chunk := await file.read(UPLOAD_CHUNK):
+            contents += chunk
+            if len(contents) > MAX_UPLOAD:
+                raise HTTPException(status_code=413, detail="Файл слишком большой")
+
+        # 2. Base64 для Vision: поддерживаемые форматы отправляем как есть,
+        #    остальные перекодируем в PNG
+        mime = file.content_type
+        if mime in SUPPORTED_IMAGE_TYPES:
+            img_b64 = base64.b64encode(contents).decode("utf-8")
+        else:
+            from PIL import Image
+
+            image = Image.open(io.BytesIO(contents))
+            buffered = io.BytesIO()
+            image.save(buffered, format="PNG")
+            img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+            mime = "image/png"
 
         # 3. Запрос к GPT-4o-mini (мультимодалка)
-        response = client.chat.completions.create(
+        # SDK синхронный - уводим вызов с event loop
+        response = await asyncio.to_thread(
+            get_client().chat.completions.create,
             model="gpt-4o-mini",
             messages=[
                 {
@@ -57,7 +95,7 @@ async def analyze_image(
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{img_b64}"
+                                "url": f"data:{mime};base64,{img_b64}"
                             }
                         }
                     ]
@@ -77,6 +115,8 @@ async def analyze_image(
         logger.info(f"Анализ успешен: {file.filename}")
         return result
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка анализа: {str(e)}")
         return {"status": "error", "message": str(e)}
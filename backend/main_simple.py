@@ -1,20 +1,20 @@
 import os
-import json
+import asyncio
+import hashlib
 import sqlite3
 import logging
-import requests
+import threading
+import httpx
+import orjson
 from datetime import datetime
+from functools import lru_cache
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.units import inch
-from reportlab.lib import colors
 from dotenv import load_dotenv
 import uvicorn
 
@@ -28,27 +28,115 @@ PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
 DB_PATH = "analyses.db"
 STATIC_DIR = Path(__file__).parent / "static"
 
-app = FastAPI(title="CompetitionMonitor MVP", version="1.0")
+_HEADERS = {
+    "Authorization": f"Bearer {API_KEY}",
+    "Content-Type": "application/json"
+}
+
+PROMPT_TEMPLATE = """Проанализируй информацию о конкуренте. Дай SWOT анализ.
+
+Информация:
+{text}
+
+Верни ТОЛЬКО валидный JSON без markdown:
+{{
+    "strengths": "Сильные стороны",
+    "weaknesses": "Слабые стороны",
+    "opportunities": "Возможности",
+    "threats": "Угрозы",
+    "recommendations": "Рекомендации",
+    "image_insights": "Insights если есть фото"
+}}"""
+
+def _extract_json(s: str) -> Optional[str]:
+    """Возвращает первый сбалансированный JSON-объект из текста (без regex-бэктрекинга)"""
+    start = s.find('{')
+    if start < 0:
+        return None
+    
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(s)):
+        ch = s[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
+
+app = FastAPI(title="CompetitionMonitor MVP", version="1.0", default_response_class=ORJSONResponse)
+
+# Общий клиент: keep-alive + HTTP/2, TLS-рукопожатие один раз на процесс
+PPX_CLIENT = httpx.AsyncClient(
+    http2=True,
+    headers=_HEADERS,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=20)
+)
+
+@app.on_event("shutdown")
+async def close_clients():
+    await PPX_CLIENT.aclose()
+
+# Одно соединение на процесс: WAL позволяет читать во время записи
+DB = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+DB.execute("PRAGMA journal_mode=WAL")
+DB.execute("PRAGMA synchronous=NORMAL")
+DB.execute("PRAGMA cache_size=-20000")
+DB_LOCK = threading.Lock()
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS analyses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            competitor_name TEXT NOT NULL,
-            analysis_text TEXT NOT NULL,
-            image_base64 TEXT,
-            analysis_result TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with DB_LOCK:
+        DB.execute('''
+            CREATE TABLE IF NOT EXISTS analyses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                competitor_name TEXT NOT NULL,
+                analysis_text TEXT NOT NULL,
+                image_base64 TEXT,
+                analysis_result TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
     logger.info("✅ База данных инициализирована")
 
 init_db()
 
+# Синхронные обёртки над БД - из async-обработчиков вызываются через asyncio.to_thread
+def _fetchone(sql: str, params: tuple = ()):
+    with DB_LOCK:
+        return DB.execute(sql, params).fetchone()
+
+def _fetchall(sql: str, params: tuple = ()):
+    with DB_LOCK:
+        return DB.execute(sql, params).fetchall()
+
+@contextmanager
+def _transaction():
+    """Явная транзакция поверх autocommit-соединения: один COMMIT на пачку записей"""
+    with DB_LOCK:
+        DB.execute("BEGIN IMMEDIATE")
+        try:
+            yield DB
+            DB.execute("COMMIT")
+        except BaseException:
+            # Сбой COMMIT (SQLITE_BUSY, диск) тоже откатываем - иначе общее
+            # соединение останется внутри открытой транзакции
+            if DB.in_transaction:
+                DB.execute("ROLLBACK")
+            raise
+
 class AnalysisRequest(BaseModel):
     text: str
     competitor_name: str = "Конкурент"
@@ -57,26 +145,11 @@ class AnalysisRequest(BaseModel):
 class CompareRequest(BaseModel):
     analysis_ids: list[int]
 
-def analyze_with_perplexity(text: str, image_base64: Optional[str] = None) -> dict:
-    logger.info("🔑 API ключ: " + API_KEY[:20] + "...")
-    
+async def analyze_with_perplexity(text: str, image_base64: Optional[str] = None) -> dict:
     content = [
         {
             "type": "text",
-            "text": f"""Проанализируй информацию о конкуренте. Дай SWOT анализ.
-
-Информация:
-{text}
-
-Верни ТОЛЬКО валидный JSON без markdown:
-{{
-    "strengths": "Сильные стороны",
-    "weaknesses": "Слабые стороны",
-    "opportunities": "Возможности",
-    "threats": "Угрозы",
-    "recommendations": "Рекомендации",
-    "image_insights": "Insights если есть фото"
-}}"""
+            "text": PROMPT_TEMPLATE.format(text=text)
         }
     ]
     
@@ -86,11 +159,6 @@ def analyze_with_perplexity(text: str, image_base64: Optional[str] = None) -> di
             "image": image_base64
         })
     
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
     payload = {
         "model": "sonar",
         "messages": [{"role": "user", "content": content}],
@@ -101,83 +169,131 @@ def analyze_with_perplexity(text: str, image_base64: Optional[str] = None) -> di
     logger.info("📤 Отправляю в Perplexity...")
     
     try:
-        response = requests.post(PERPLEXITY_URL, headers=headers, json=payload)
+        response = await PPX_CLIENT.post(PERPLEXITY_URL, content=orjson.dumps(payload))
         logger.info(f"📥 Status: {response.status_code}")
         
         if response.status_code != 200:
             logger.error(f"❌ Ошибка: {response.text}")
             return {"error": f"API error: {response.status_code}"}
         
-        data = response.json()
+        data = orjson.loads(response.content)
         response_text = data["choices"][0]["message"]["content"]
         
         try:
-            analysis = json.loads(response_text)
+            analysis = orjson.loads(response_text)
             logger.info("✨ JSON распарсен!")
             return analysis
-        except json.JSONDecodeError:
-            import re
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                analysis = json.loads(json_match.group())
+        except orjson.JSONDecodeError:
+            json_str = _extract_json(response_text)
+            if json_str:
+                analysis = orjson.loads(json_str)
                 logger.info("✨ JSON извлечен!")
                 return analysis
             return {"error": "Invalid JSON"}
     
+    except httpx.TimeoutException:
+        logger.error("❌ Timeout: Perplexity не ответил")
+        return {"error": "Timeout"}
+    except httpx.ConnectError as e:
+        logger.error(f"❌ Нет соединения с Perplexity: {str(e)}")
+        return {"error": f"Connection error: {str(e)}"}
     except Exception as e:
         logger.error(f"❌ Ошибка: {str(e)}")
         return {"error": str(e)}
 
 def save_analysis(competitor_name: str, text: str, analysis: dict, image_base64: Optional[str] = None) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO analyses (competitor_name, analysis_text, image_base64, analysis_result)
-        VALUES (?, ?, ?, ?)
-    ''', (competitor_name, text, image_base64, json.dumps(analysis)))
-    conn.commit()
-    analysis_id = cursor.lastrowid
-    conn.close()
+    with _transaction() as db:
+        analysis_id = db.execute('''
+            INSERT INTO analyses (competitor_name, analysis_text, image_base64, analysis_result)
+            VALUES (?, ?, ?, ?)
+        ''', (competitor_name, text, image_base64, orjson.dumps(analysis).decode())).lastrowid
     logger.info(f"💾 Сохранено ID: {analysis_id}")
     return analysis_id
 
+# Стили PDF не меняются между запросами - собираем один раз, при первом PDF
+@lru_cache(maxsize=1)
+def _pdf_styles() -> dict:
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib import colors
+    
+    styles = getSampleStyleSheet()
+    heading = ParagraphStyle(
+        'SectionHeading',
+        parent=styles['Heading2'],
+        fontSize=14,
+        textColor=colors.HexColor("#333"),
+        spaceAfter=10,
+        spaceBefore=10
+    )
+    
+    return {
+        "title": ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=24,
+            textColor=colors.HexColor("#667eea"),
+            spaceAfter=30,
+            alignment=1
+        ),
+        "date": ParagraphStyle(
+            'DateStyle',
+            parent=styles['Normal'],
+            fontSize=10,
+            textColor=colors.grey,
+            alignment=2
+        ),
+        "heading": heading,
+        "accent_heading": ParagraphStyle(
+            'RecommendationsHeading',
+            parent=heading,
+            textColor=colors.HexColor("#667eea")
+        ),
+        "text": ParagraphStyle(
+            'SectionText',
+            parent=styles['Normal'],
+            fontSize=11,
+            textColor=colors.HexColor("#555"),
+            spaceAfter=15
+        ),
+    }
+
 def generate_pdf(analysis_id: int, competitor_name: str) -> str:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT analysis_result FROM analyses WHERE id = ?', (analysis_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with DB_LOCK:
+        row = DB.execute('SELECT analysis_result, created_at FROM analyses WHERE id = ?', (analysis_id,)).fetchone()
     
     if not row:
         return None
     
-    analysis = json.loads(row[0])
-    pdf_path = f"analysis_{analysis_id}.pdf"
+    # Готовый PDF отдаём повторно, только если он построен из этой же записи:
+    # имя файла привязано к хэшу содержимого, а не к одному id
+    digest = hashlib.sha1(f"{competitor_name}\0{row[0]}".encode()).hexdigest()[:16]
+    pdf_path = f"analysis_{analysis_id}_{digest}.pdf"
+    if Path(pdf_path).exists():
+        return pdf_path
     
-    doc = SimpleDocTemplate(pdf_path, pagesize=letter)
-    elements = []
-    styles = getSampleStyleSheet()
+    analysis = orjson.loads(row[0])
     
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        textColor=colors.HexColor("#667eea"),
-        spaceAfter=30,
-        alignment=1
-    )
+    # ReportLab тяжёлый на импорт - грузим только когда реально строим PDF
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
     
-    elements.append(Paragraph(f"📊 Анализ: {competitor_name}", title_style))
+    styles = _pdf_styles()
+    # Строим во временный файл и подменяем атомарно - параллельный запрос
+    # никогда не увидит недописанный PDF
+    tmp_path = f"{pdf_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    doc = SimpleDocTemplate(tmp_path, pagesize=letter)
+    elements = []
+    
+    elements.append(Paragraph(f"📊 Анализ: {competitor_name}", styles["title"]))
     elements.append(Spacer(1, 0.3*inch))
     
-    date_style = ParagraphStyle(
-        'DateStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.grey,
-        alignment=2
-    )
-    elements.append(Paragraph(f"Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}", date_style))
+    # Дата берётся из записи, а не из момента генерации - кэш и свежая сборка совпадают
+    try:
+        created = datetime.fromisoformat(row[1]).strftime('%d.%m.%Y %H:%M')
+    except (TypeError, ValueError):
+        created = row[1] or "—"
+    elements.append(Paragraph(f"Дата: {created}", styles["date"]))
     elements.append(Spacer(1, 0.2*inch))
     
     sections = [
@@ -189,57 +305,40 @@ def generate_pdf(analysis_id: int, competitor_name: str) -> str:
     
     for title, key in sections:
         if key in analysis and analysis[key]:
-            heading = ParagraphStyle(
-                f'Heading_{key}',
-                parent=styles['Heading2'],
-                fontSize=14,
-                textColor=colors.HexColor("#333"),
-                spaceAfter=10,
-                spaceBefore=10
-            )
-            elements.append(Paragraph(title, heading))
-            
-            text_style = ParagraphStyle(
-                f'Text_{key}',
-                parent=styles['Normal'],
-                fontSize=11,
-                textColor=colors.HexColor("#555"),
-                spaceAfter=15
-            )
-            elements.append(Paragraph(analysis[key], text_style))
+            elements.append(Paragraph(title, styles["heading"]))
+            elements.append(Paragraph(analysis[key], styles["text"]))
     
     if "recommendations" in analysis and analysis["recommendations"]:
-        heading = ParagraphStyle(
-            'RecommendationsHeading',
-            parent=styles['Heading2'],
-            fontSize=14,
-            textColor=colors.HexColor("#667eea"),
-            spaceAfter=10,
-            spaceBefore=10
-        )
-        elements.append(Paragraph("📋 Рекомендации", heading))
-        
-        text_style = ParagraphStyle(
-            'RecommendationsText',
-            parent=styles['Normal'],
-            fontSize=11,
-            textColor=colors.HexColor("#555"),
-            spaceAfter=15
-        )
-        elements.append(Paragraph(analysis["recommendations"], text_style))
+        elements.append(Paragraph("📋 Рекомендации", styles["accent_heading"]))
+        elements.append(Paragraph(analysis["recommendations"], styles["text"]))
     
-    doc.build(elements)
+    try:
+        doc.build(elements)
+        os.replace(tmp_path, pdf_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    # Запись могла смениться - старые версии этого анализа больше не нужны
+    for stale in Path(".").glob(f"analysis_{analysis_id}_*.pdf"):
+        if stale.name != pdf_path:
+            try:
+                stale.unlink()
+            except OSError:
+                pass
     logger.info(f"📄 PDF: {pdf_path}")
     return pdf_path
 
 if STATIC_DIR.exists():
     app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
+# Фронтенд статичен - читаем один раз при старте
+_INDEX_PATH = STATIC_DIR / "index.html"
+_INDEX_BYTES = _INDEX_PATH.read_bytes() if _INDEX_PATH.exists() else None
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
-    html_path = STATIC_DIR / "index.html"
-    if html_path.exists():
-        return open(html_path, encoding='utf-8').read()
+    if _INDEX_BYTES is not None:
+        return Response(_INDEX_BYTES, media_type="text/html")
     return "<h1>CompetitionMonitor MVP готов!</h1><p>Frontend не найден</p>"
 
 @app.post("/analyzetext")
@@ -247,12 +346,13 @@ async def analyze_text(request: AnalysisRequest):
     try:
         logger.info(f"🔍 Анализирую: {request.competitor_name}")
         
-        analysis = analyze_with_perplexity(request.text, request.image)
+        analysis = await analyze_with_perplexity(request.text, request.image)
         
         if "error" in analysis:
             return {"success": False, "analysis": analysis}
         
-        analysis_id = save_analysis(
+        analysis_id = await asyncio.to_thread(
+            save_analysis,
             request.competitor_name,
             request.text,
             analysis,
@@ -270,12 +370,13 @@ async def analyze_text(request: AnalysisRequest):
         return {"success": False, "analysis": {"error": str(e)}}
 
 @app.get("/history")
-async def get_history():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, competitor_name, created_at FROM analyses ORDER BY created_at DESC')
-    rows = cursor.fetchall()
-    conn.close()
+async def get_history(limit: int = Query(50, ge=1, le=500), before_id: Optional[int] = Query(None, ge=1)):
+    rows = await asyncio.to_thread(
+        _fetchall,
+        'SELECT id, competitor_name, created_at FROM analyses '
+        'WHERE (? IS NULL OR id < ?) ORDER BY id DESC LIMIT ?',
+        (before_id, before_id, limit)
+    )
     
     history = [
         {
@@ -290,11 +391,9 @@ async def get_history():
 
 @app.get("/analysis/{analysis_id}")
 async def get_analysis(analysis_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT competitor_name, analysis_result FROM analyses WHERE id = ?', (analysis_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = await asyncio.to_thread(
+        _fetchone, 'SELECT competitor_name, analysis_result FROM analyses WHERE id = ?', (analysis_id,)
+    )
     
     if not row:
         raise HTTPException(status_code=404, detail="Analysis not found")
@@ -302,45 +401,46 @@ async def get_analysis(analysis_id: int):
     return {
         "success": True,
         "competitor_name": row[0],
-        "analysis": json.loads(row[1])
+        "analysis": orjson.loads(row[1])
     }
 
 @app.get("/export-pdf/{analysis_id}")
 async def export_pdf(analysis_id: int):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT competitor_name FROM analyses WHERE id = ?', (analysis_id,))
-        row = cursor.fetchone()
-        conn.close()
+        row = await asyncio.to_thread(
+            _fetchone, 'SELECT competitor_name FROM analyses WHERE id = ?', (analysis_id,)
+        )
         
         if not row:
             raise HTTPException(status_code=404, detail="Analysis not found")
         
-        pdf_path = generate_pdf(analysis_id, row[0])
-        return FileResponse(pdf_path, filename=f"analysis_{analysis_id}.pdf")
+        pdf_path = await asyncio.to_thread(generate_pdf, analysis_id, row[0])
+        return FileResponse(
+            pdf_path,
+            filename=f"analysis_{analysis_id}.pdf",
+            headers={"Cache-Control": "no-cache"}
+        )
     
     except Exception as e:
         logger.error(f"❌ Ошибка PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/compare")
-async def compare_competitors(request: CompareRequest):
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        competitors = []
-        for analysis_id in request.analysis_ids:
-            cursor.execute('SELECT competitor_name, analysis_result FROM analyses WHERE id = ?', (analysis_id,))
-            row = cursor.fetchone()
+def _fetch_competitors(analysis_ids: list[int]) -> list[dict]:
+    competitors = []
+    with DB_LOCK:
+        for analysis_id in analysis_ids:
+            row = DB.execute('SELECT competitor_name, analysis_result FROM analyses WHERE id = ?', (analysis_id,)).fetchone()
             if row:
                 competitors.append({
                     "name": row[0],
-                    "analysis": json.loads(row[1])
+                    "analysis": orjson.loads(row[1])
                 })
-        
-        conn.close()
+    return competitors
+
+@app.post("/compare")
+async def compare_competitors(request: CompareRequest):
+    try:
+        competitors = await asyncio.to_thread(_fetch_competitors, request.analysis_ids)
         
         if not competitors:
             raise HTTPException(status_code=404, detail="No analyses found")
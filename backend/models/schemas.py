@@ -104,7 +104,7 @@ class HealthCheckResponse(BaseModel):
 
 class HistoryItem(BaseModel):
     """Элемент истории запроса"""
-    id: str = Field(..., description="UUID запроса")
+    id: str = Field(..., description="UUID запроса (32 hex-символа без дефисов)")
     timestamp: datetime = Field(..., description="Время запроса")
     request_type: str = Field(..., description="Тип запроса: text, image, parse")
     request_summary: str = Field(..., description="Краткое резюме запроса (до 200 символов)")
@@ -1,10 +1,14 @@
-import json
+import os
 import uuid
+import asyncio
 import logging
+import threading
+from collections import Counter
 from datetime import datetime
 from pathlib import Path
-from typing import List
-from backend.config import settings
+from typing import List, Optional
+import orjson
+from backend.config import get_settings
 from backend.models.schemas import HistoryItem
 
 logger = logging.getLogger("competitionmonitor.history")
@@ -13,13 +17,35 @@ logger = logging.getLogger("competitionmonitor.history")
 class HistoryService:
     """
     Сервис для управления историей запросов
-    Сохраняет в JSON файл локально
+    Сохраняет в JSONL файл локально (одна запись на строку, только дозапись)
     """
     
+    # Во сколько раз файл может перерасти max_items до компактации
+    COMPACT_FACTOR = 2
+    # Интервал, за который накопленные записи сбрасываются на диск одной пачкой (сек)
+    FLUSH_INTERVAL = 0.5
+    
     def __init__(self):
         """Инициализация сервиса истории"""
+        settings = get_settings()
         self.history_file = Path(settings.history_file)
         self.max_items = settings.max_history_items
+        self._line_count = 0
+        # Файл не заканчивается переводом строки (оборванная последняя запись)
+        self._needs_newline = False
+        
+        # Строки, ещё не записанные на диск фоновым flusher'ом
+        self._pending: List[bytes] = []
+        self._dirty_event: Optional[asyncio.Event] = None
+        self._flusher_task: Optional[asyncio.Task] = None
+        # Цикл, в котором живёт flusher: add_entry может вызываться из пула потоков
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Очередь и копия в памяти меняются и из потоков, и из цикла
+        self._state_lock = threading.Lock()
+        # Запись в файл идёт и из потоков flusher'а, и синхронно - сериализуем
+        self._io_lock = threading.Lock()
+        # Растёт при очистке: пачки, взятые до неё, на диск уже не пишутся
+        self._generation = 0
         
         logger.info("=" * 60)
         logger.info("🔧 Инициализация HistoryService")
@@ -27,56 +53,248 @@ class HistoryService:
         logger.info(f"📁 История файл: {self.history_file.absolute()}")
         logger.info(f"📊 Макс элементов: {self.max_items}")
         
+        self._migrate_legacy()
         self._ensure_file_exists()
         
-        # Загружаем текущую историю
-        history = self.load_history()
-        logger.info(f"📝 Загружено {len(history)} записей истории")
+        # Загружаем историю один раз - дальше работаем с копией в памяти
+        self._history = self.load_history()
+        
+        # Счётчики для статистики считаем один раз, дальше обновляем инкрементально
+        self._type_counts = Counter()
+        self._total_tokens = 0
+        for h in self._history:
+            self._count(h, 1)
+        logger.info(f"📝 Загружено {len(self._history)} записей истории")
         logger.info("=" * 60)
     
+    def _count(self, item: dict, sign: int):
+        """Учитывает (+1) или вычитает (-1) запись из счётчиков статистики"""
+        self._type_counts[item.get("request_type")] += sign
+        self._total_tokens += sign * (item.get("tokens_used") or 0)
+    
     def _ensure_file_exists(self):
         """Создаёт файл истории если его нет"""
         if not self.history_file.exists():
             logger.info(f"📁 Создание файла истории: {self.history_file}")
-            self.history_file.write_text("[]", encoding="utf-8")
+            self.history_file.write_bytes(b"")
             logger.info("✅ Файл истории создан")
         else:
             logger.debug(f"✅ Файл истории уже существует")
     
+    def _migrate_legacy(self):
+        """
+        Переводит историю старого формата (JSON-массив, новые первыми) в JSONL.
+        Источник - сам файл истории, если в нём массив, либо соседний history.json
+        """
+        legacy_file = self.history_file
+        if not self._is_legacy(legacy_file):
+            legacy_file = self.history_file.with_suffix(".json")
+            if self.history_file.exists() or not self._is_legacy(legacy_file):
+                return
+        
+        logger.info("🔄 Миграция истории из %s", legacy_file)
+        try:
+            items = orjson.loads(legacy_file.read_bytes())
+            if not isinstance(items, list):
+                raise ValueError("ожидался JSON-массив")
+        except ValueError as e:
+            # Битый старый файл откладываем в сторону, чтобы не смешивать его с JSONL
+            backup = legacy_file.with_name(legacy_file.name + ".corrupt")
+            logger.error("❌ Не удалось прочитать старую историю (%s), файл переименован в %s", e, backup)
+            legacy_file.replace(backup)
+            return
+        
+        self.history_file.write_bytes(
+            b"".join(orjson.dumps(item) + b"\n" for item in reversed(items))
+        )
+        logger.info("✅ Перенесено %d записей истории", len(items))
+    
+    @staticmethod
+    def _is_legacy(path: Path) -> bool:
+        """Файл в старом формате: первый значимый символ - '['"""
+        try:
+            with open(path, "rb") as f:
+                head = f.read(64).lstrip()
+        except FileNotFoundError:
+            return False
+        return head.startswith(b"[")
+    
     def load_history(self) -> List[dict]:
         """
-        Загружает историю из JSON файла
+        Загружает историю из JSONL файла.
+        Битые строки (например, оборванная при падении последняя запись) пропускаются
         
         Returns:
-            List[dict]: Список записей истории
+            List[dict]: Список записей истории (новые первыми)
         """
         try:
-            content = self.history_file.read_text(encoding="utf-8")
-            history = json.loads(content)
-            logger.debug(f"✅ История загружена ({len(history)} записей)")
-            return history
-        except json.JSONDecodeError as e:
-            logger.warning(f"⚠️  Ошибка парсинга JSON: {str(e)}")
-            return []
+            data = self.history_file.read_bytes()
         except FileNotFoundError:
             logger.warning(f"⚠️  Файл истории не найден")
             return []
+        
+        records = []
+        line_count = 0
+        for line in data.splitlines():
+            if not line:
+                continue
+            line_count += 1
+            try:
+                item = orjson.loads(line)
+                # Записи наши - валидацию не гоняем, только приводим время к datetime
+                item["timestamp"] = datetime.fromisoformat(item["timestamp"])
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning("⚠️  Пропущена битая запись истории (строка %d): %s", line_count, e)
+                continue
+            records.append(item)
+        
+        # Битые строки тоже занимают место в файле - компактация их вычистит
+        self._line_count = line_count
+        self._needs_newline = bool(data) and not data.endswith(b"\n")
+        history = records[::-1][:self.max_items]
+        logger.debug("✅ История загружена (%d записей)", len(history))
+        return history
+    
+    def _write_all(self, history: List[dict]):
+        """Атомарно перезаписывает файл (через временный файл); вызывать под _io_lock"""
+        tmp_file = self.history_file.with_name(self.history_file.name + ".tmp")
+        tmp_file.write_bytes(
+            b"".join(orjson.dumps(item) + b"\n" for item in reversed(history))
+        )
+        os.replace(tmp_file, self.history_file)
+        self._line_count = len(history)
+        self._needs_newline = False
     
     def save_history(self, history: List[dict]):
         """
-        Сохраняет историю в JSON файл
+        Перезаписывает JSONL файл целиком
         
         Args:
-            history: Список записей для сохранения
+            history: Список записей для сохранения (новые первыми)
         """
         try:
-            self.history_file.write_text(
-                json.dumps(history, ensure_ascii=False, indent=2, default=str),
-                encoding="utf-8"
-            )
-            logger.debug(f"✅ История сохранена ({len(history)} записей)")
+            with self._io_lock:
+                self._write_all(history)
+            logger.debug("✅ История сохранена (%d записей)", len(history))
         except Exception as e:
-            logger.error(f"❌ Ошибка сохранения истории: {str(e)}")
+            logger.error("❌ Ошибка сохранения истории: %s", e)
+    
+    def _take_pending(self):
+        """
+        Забирает накопленные строки; если файл перерос лимит - ещё и снимок истории для компактации
+        
+        Returns:
+            tuple: (строки для дозаписи, снимок истории или None, поколение)
+        """
+        with self._state_lock:
+            lines, self._pending = self._pending, []
+            snapshot = None
+            if self._line_count > self.max_items * self.COMPACT_FACTOR:
+                snapshot = list(self._history)
+            return lines, snapshot, self._generation
+    
+    def _flush(self, lines: List[bytes], snapshot: Optional[List[dict]], generation: int):
+        """
+        Дописывает строки одной операцией или перезаписывает файл снимком (компактация).
+        Ошибки записи пробрасываются вызывающему
+        """
+        with self._io_lock:
+            if generation != self._generation:
+                # История очищена после того, как пачка была взята
+                return
+            if snapshot is not None:
+                # Снимок уже содержит все накопленные записи
+                logger.debug("🗜️  Компактация истории (%d строк)", self._line_count)
+                self._write_all(snapshot)
+            elif lines:
+                data = b"".join(lines)
+                # Не приклеиваем новые записи к оборванной последней строке
+                if self._needs_newline:
+                    data = b"\n" + data
+                with open(self.history_file, "ab") as f:
+                    f.write(data)
+                self._needs_newline = False
+    
+    def _requeue(self, error: Exception, lines: List[bytes], generation: int):
+        """Логирует ошибку записи и возвращает строки в начало очереди"""
+        logger.error("❌ Ошибка записи истории (%d записей отложено): %s", len(lines), error)
+        with self._state_lock:
+            if generation == self._generation:
+                self._pending[:0] = lines
+    
+    def _flush_now(self):
+        """Синхронный сброс очереди (без flusher'а)"""
+        lines, snapshot, generation = self._take_pending()
+        try:
+            self._flush(lines, snapshot, generation)
+        except Exception as e:
+            self._requeue(e, lines, generation)
+    
+    async def _flush_pending(self):
+        """Сброс очереди в пуле потоков; при ошибке строки остаются в очереди"""
+        lines, snapshot, generation = self._take_pending()
+        try:
+            await asyncio.to_thread(self._flush, lines, snapshot, generation)
+        except Exception as e:
+            self._requeue(e, lines, generation)
+    
+    async def _flusher(self):
+        """Фоновая задача: сбрасывает накопленные записи не чаще раза в FLUSH_INTERVAL"""
+        while True:
+            await self._dirty_event.wait()
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            self._dirty_event.clear()
+            await self._flush_pending()
+    
+    def start_flusher(self):
+        """Запускает фоновый flusher (вызывать из startup приложения)"""
+        if self._flusher_task is None:
+            self._loop = asyncio.get_running_loop()
+            self._dirty_event = asyncio.Event()
+            self._flusher_task = asyncio.create_task(self._flusher())
+            logger.debug("✅ Фоновая запись истории запущена")
+    
+    async def stop_flusher(self):
+        """Останавливает flusher и дописывает остаток (вызывать из shutdown приложения)"""
+        if self._flusher_task is None:
+            return
+        task, self._flusher_task = self._flusher_task, None
+        self._dirty_event = None
+        self._loop = None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error("❌ Фоновая запись истории завершилась с ошибкой: %s", e)
+        # Если отменили посреди записи, поток её допишет - _io_lock дождётся его
+        await self._flush_pending()
+    
+    def _signal_dirty(self) -> bool:
+        """
+        Будит flusher. asyncio.Event не потокобезопасен, поэтому из чужого потока
+        set() передаётся в цикл flusher'а через call_soon_threadsafe
+        
+        Returns:
+            bool: False, если flusher не запущен (или уже остановлен)
+        """
+        event, loop = self._dirty_event, self._loop
+        if event is None or loop is None:
+            return False
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            event.set()
+            return True
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # Цикл уже закрыт
+            return False
+        return True
     
     def add_entry(
         self,
@@ -86,7 +304,8 @@ class HistoryService:
         tokens_used: int = None
     ) -> HistoryItem:
         """
-        Добавляет новую запись в историю
+        Добавляет новую запись в историю.
+        Можно вызывать как из event loop, так и из пула потоков
         
         Args:
             request_type: Тип запроса (text, image, parse)
@@ -97,42 +316,42 @@ class HistoryService:
         Returns:
             HistoryItem: Добавленная запись
         """
-        logger.info("=" * 60)
-        logger.info(f"📝 Добавление записи в историю (тип: {request_type})")
-        logger.info("=" * 60)
-        
-        history = self.load_history()
-        
         # Обрезаем резюме если слишком длинные
         request_summary = request_summary[:200]
         response_summary = response_summary[:500]
         
         # Создаём новую запись
+        # datetime сериализует сам orjson (ISO 8601), isoformat не нужен
         item_dict = {
-            "id": str(uuid.uuid4()),
-            "timestamp": datetime.now().isoformat(),
+            "id": uuid.uuid4().hex,
+            "timestamp": datetime.now(),
             "request_type": request_type,
             "request_summary": request_summary,
             "response_summary": response_summary,
             "tokens_used": tokens_used
         }
         
-        # Добавляем в начало (новые записи первыми)
-        history.insert(0, item_dict)
-        
-        # Ограничиваем количество записей
-        history = history[:self.max_items]
+        line = orjson.dumps(item_dict) + b"\n"
+        with self._state_lock:
+            self._pending.append(line)
+            self._line_count += 1
+            
+            self._history.insert(0, item_dict)
+            self._count(item_dict, 1)
+            for evicted in self._history[self.max_items:]:
+                self._count(evicted, -1)
+            del self._history[self.max_items:]
         
-        # Сохраняем
-        self.save_history(history)
+        # С запущенным flusher'ом запись на диск откладывается и объединяется в пачки;
+        # без него - пишем сразу (старые записи вычищаются компактацией пачкой)
+        if not self._signal_dirty():
+            self._flush_now()
         
-        logger.info(f"✅ Запись добавлена")
-        logger.info(f"   🔑 ID: {item_dict['id']}")
-        logger.info(f"   📝 Тип: {request_type}")
-        logger.info(f"   📊 Запрос: {request_summary[:50]}...")
-        logger.info("=" * 60)
+        logger.info("📝 Запись добавлена в историю: id=%s, тип=%s", item_dict["id"], request_type)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("   📊 Запрос: %s...", request_summary[:50])
         
-        return HistoryItem(**item_dict)
+        return HistoryItem.model_construct(**item_dict)
     
     def get_history(self) -> List[HistoryItem]:
         """
@@ -141,12 +360,19 @@ class HistoryService:
         Returns:
             List[HistoryItem]: Список моделей HistoryItem
         """
-        history = self.load_history()
-        return [HistoryItem(**item) for item in history]
+        with self._state_lock:
+            items = list(self._history)
+        return [HistoryItem.model_construct(**item) for item in items]
     
     def clear_history(self):
         """Очищает всю историю"""
         logger.warning("🧹 Очистка всей истории...")
+        with self._state_lock:
+            self._history.clear()
+            self._pending.clear()
+            self._type_counts.clear()
+            self._total_tokens = 0
+            self._generation += 1
         self.save_history([])
         logger.info("✅ История очищена")
     
@@ -157,23 +383,16 @@ class HistoryService:
         Returns:
             dict: Статистика использования
         """
-        history = self.load_history()
-        
-        text_count = sum(1 for h in history if h.get("request_type") == "text")
-        image_count = sum(1 for h in history if h.get("request_type") == "image")
-        parse_count = sum(1 for h in history if h.get("request_type") == "parse")
-        total_tokens = sum(h.get("tokens_used", 0) for h in history)
-        
         stats = {
-            "total_requests": len(history),
-            "text_requests": text_count,
-            "image_requests": image_count,
-            "parse_requests": parse_count,
-            "total_tokens_used": total_tokens,
+            "total_requests": len(self._history),
+            "text_requests": self._type_counts["text"],
+            "image_requests": self._type_counts["image"],
+            "parse_requests": self._type_counts["parse"],
+            "total_tokens_used": self._total_tokens,
             "max_items": self.max_items
         }
         
-        logger.info(f"📊 Статистика истории: {stats}")
+        logger.info("📊 Статистика истории: %s", stats)
         return stats
 
 
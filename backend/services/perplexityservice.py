@@ -1,14 +1,162 @@
-import json
 import re
 import time
 import logging
 from typing import Optional
-import requests
-from backend.config import settings
+import httpx
+import orjson
+from backend.config import get_settings
 from backend.models.schemas import CompetitorAnalysis
 
 logger = logging.getLogger("competitionmonitor.perplexity")
 
+# Сколько символов текста конкурента отправляем в промпт
+MAX_TEXT_CHARS = 3000
+
+# Системный промпт для анализа конкурентов
+_SYSTEM_PROMPT = """Ты эксперт по анализу конкурентов. Твоя задача - глубоко анализировать информацию о конкурентах и предоставлять структурированные, практические insights.
+
+Анализируй следующие аспекты:
+1. СИЛЬНЫЕ СТОРОНЫ - Что делает конкурент хорошо?
+2. СЛАБЫЕ СТОРОНЫ - Где у него пробелы?
+3. УНИКАЛЬНЫЕ ПРЕДЛОЖЕНИЯ - Что выделяет его на рынке?
+4. ВОЗМОЖНОСТИ - Как можно атаковать/конкурировать?
+5. РЕКОМЕНДАЦИИ - Конкретные шаги по противодействию
+
+Отвечай ТОЛЬКО в JSON формате, без дополнительного текста."""
+
+_USER_PROMPT_TPL = """
+Проанализируй следующую информацию о конкуренте:
+
+{text}
+
+Верни ответ в точно таком JSON формате:
+{{
+    "strengths": ["сильная сторона 1", "сильная сторона 2", ...],
+    "weaknesses": ["слабая сторона 1", "слабая сторона 2", ...],
+    "unique_offers": ["уникальное предложение 1", "уникальное предложение 2", ...],
+    "opportunities": ["возможность атаки 1", "возможность атаки 2", ...],
+    "recommendations": ["рекомендация 1", "рекомендация 2", ...],
+    "summary": "Краткое резюме анализа (3-5 предложений)"
+}}
+
+Будь конкретен. Каждый пункт должен быть actionable (применяемым).
+"""
+
+_MD_JSON_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+
+
+class _JsonScanner:
+    """
+    Инкрементально ищет конец первого сбалансированного JSON-объекта.
+    Позволяет остановить чтение потока, как только объект закрыт.
+    """
+    
+    __slots__ = ("parts", "pos", "start", "end", "depth", "in_str", "escape")
+    
+    def __init__(self):
+        self.parts = []
+        self.pos = 0
+        self.start = -1
+        self.end = -1
+        self.depth = 0
+        self.in_str = False
+        self.escape = False
+    
+    def feed(self, chunk: str) -> bool:
+        """
+        Добавляет кусок текста и продолжает сканирование с места остановки
+        
+        Returns:
+            bool: True, если первый объект полностью получен
+        """
+        self.parts.append(chunk)
+        if self.end >= 0:
+            return True
+        
+        pos = self.pos
+        for ch in chunk:
+            if self.start < 0:
+                if ch == "{":
+                    self.start = pos
+                    self.depth = 1
+            elif self.in_str:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                self.in_str = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = pos + 1
+                    self.pos = pos + 1
+                    return True
+            pos += 1
+        
+        self.pos = pos
+        return False
+    
+    def text(self) -> str:
+        """Весь накопленный текст"""
+        return "".join(self.parts)
+    
+    def result(self) -> str:
+        """
+        Найденный объект; если объекта нет - JSON из markdown блока или исходный текст
+        """
+        content = self.text()
+        if self.start < 0:
+            json_match = _MD_JSON_RE.search(content)
+            return json_match.group(1) if json_match else content
+        if self.end < 0:
+            return content[self.start:]
+        return content[self.start:self.end]
+
+
+def _extract_json(content: str) -> str:
+    """
+    Вырезает первый сбалансированный JSON-объект за один проход
+    
+    Args:
+        content: Текст ответа модели
+        
+    Returns:
+        str: Найденный объект; если объекта нет - исходный текст
+    """
+    scanner = _JsonScanner()
+    scanner.feed(content)
+    return scanner.result()
+
+
+# Пустой результат для веток ошибок: собирается один раз без валидации.
+# Общий объект - вызывающий код не должен его изменять
+_EMPTY_ANALYSIS = CompetitorAnalysis.model_construct(
+    strengths=[],
+    weaknesses=[],
+    unique_offers=[],
+    opportunities=[],
+    recommendations=[],
+    summary="",
+)
+
+
+# Один HTTP клиент на процесс: пул keep-alive соединений и HTTP/2 общие для всех экземпляров
+_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    verify=False,
+    limits=httpx.Limits(max_keepalive_connections=20),
+    headers={
+        "Authorization": f"Bearer {get_settings().perplexity_api_key}",
+        "Content-Type": "application/json",
+    }
+)
+
 
 class PerplexityService:
     """
@@ -18,6 +166,7 @@ class PerplexityService:
     
     def __init__(self):
         """Инициализация Perplexity сервиса"""
+        settings = get_settings()
         self.api_key = settings.perplexity_api_key
         self.base_url = settings.perplexity_base_url
         self.model = settings.perplexity_model
@@ -44,27 +193,33 @@ class PerplexityService:
         Returns:
             dict: Распарсенный JSON
         """
-        logger.debug(f"🔍 Парсинг JSON из ответа ({len(content)} символов)")
+        logger.debug("🔍 Парсинг JSON из ответа (%d символов)", len(content))
         
-        # Пытаемся найти JSON в markdown блоках
-        json_match = re.search(r"```(?:json)?\s*(.*?)\s*```", content, re.DOTALL)
-        if json_match:
-            content = json_match.group(1)
-            logger.debug("✅ JSON найден в markdown блоке")
-        
-        # Пытаемся найти JSON в фигурных скобках
-        json_match = re.search(r"\{.*\}", content, re.DOTALL)
-        if json_match:
-            content = json_match.group(0)
-            logger.debug("✅ JSON найден в скобках")
+        # Вырезаем JSON-объект (в том числе из markdown блока) одним проходом
+        return self._load_json(_extract_json(content))
+    
+    def _load_json(self, content: str) -> dict:
+        """
+        Загружает уже вырезанный JSON-объект
         
+        Args:
+            content: Строка с JSON-объектом
+            
+        Returns:
+            dict: Распарсенный JSON или пустой dict при ошибке
+        """
         try:
-            result = json.loads(content)
-            logger.debug(f"✅ JSON успешно распарсен, ключи: {list(result.keys())}")
+            result = orjson.loads(content)
+            if not isinstance(result, dict):
+                logger.warning("⚠️  JSON не является объектом: %s", type(result).__name__)
+                return {}
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("✅ JSON успешно распарсен, ключи: %s", list(result.keys()))
             return result
-        except json.JSONDecodeError as e:
-            logger.warning(f"⚠️  Ошибка парсинга JSON: {str(e)}")
-            logger.debug(f"📝 Попытка контента: {content[:200]}...")
+        except orjson.JSONDecodeError as e:
+            logger.warning("⚠️  Ошибка парсинга JSON: %s", e)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📝 Попытка контента: %s...", content[:200])
             return {}
     
     async def analyze_text(self, text: str) -> CompetitorAnalysis:
@@ -77,59 +232,24 @@ class PerplexityService:
         Returns:
             CompetitorAnalysis: Объект с результатами анализа
         """
-        logger.info("=" * 60)
-        logger.info(f"📊 Начало анализа текста ({len(text)} символов)")
-        logger.info("=" * 60)
+        logger.info("📊 Начало анализа текста (%d символов)", len(text))
         
         if not text or len(text) < 10:
             logger.warning("⚠️  Текст слишком короткий (< 10 символов)")
-            return CompetitorAnalysis()
+            return _EMPTY_ANALYSIS
         
-        # Система промпт для анализа конкурентов
-        system_prompt = """Ты эксперт по анализу конкурентов. Твоя задача - глубоко анализировать информацию о конкурентах и предоставлять структурированные, практические insights.
-
-Анализируй следующие аспекты:
-1. СИЛЬНЫЕ СТОРОНЫ - Что делает конкурент хорошо?
-2. СЛАБЫЕ СТОРОНЫ - Где у него пробелы?
-3. УНИКАЛЬНЫЕ ПРЕДЛОЖЕНИЯ - Что выделяет его на рынке?
-4. ВОЗМОЖНОСТИ - Как можно атаковать/конкурировать?
-5. РЕКОМЕНДАЦИИ - Конкретные шаги по противодействию
-
-Отвечай ТОЛЬКО в JSON формате, без дополнительного текста."""
-        
-        analysis_prompt = f"""
-Проанализируй следующую информацию о конкуренте:
-
-{text[:3000]}
-
-Верни ответ в точно таком JSON формате:
-{{
-    "strengths": ["сильная сторона 1", "сильная сторона 2", ...],
-    "weaknesses": ["слабая сторона 1", "слабая сторона 2", ...],
-    "unique_offers": ["уникальное предложение 1", "уникальное предложение 2", ...],
-    "opportunities": ["возможность атаки 1", "возможность атаки 2", ...],
-    "recommendations": ["рекомендация 1", "рекомендация 2", ...],
-    "summary": "Краткое резюме анализа (3-5 предложений)"
-}}
-
-Будь конкретен. Каждый пункт должен быть actionable (применяемым).
-"""
+        analysis_prompt = _USER_PROMPT_TPL.format(text=text[:MAX_TEXT_CHARS])
         
         try:
             start_time = time.time()
             logger.info("🚀 Отправка запроса в Perplexity Pro...")
             
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            }
-            
             payload = {
                 "model": self.model,
                 "messages": [
                     {
                         "role": "system",
-                        "content": system_prompt
+                        "content": _SYSTEM_PROMPT
                     },
                     {
                         "role": "user",
@@ -140,42 +260,48 @@ class PerplexityService:
                 "max_tokens": 2000,
                 "top_p": 0.9,
                 "top_k": 0,
+                "stream": True,
             }
             
-            # Отправляем запрос
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                verify=False,
-                timeout=30
-            )
+            # Читаем ответ потоком и прекращаем, как только JSON-объект закрыт
+            scanner = _JsonScanner()
+            async with _CLIENT.stream("POST", self.base_url, content=orjson.dumps(payload)) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    logger.error("❌ API ошибка %d: %s", response.status_code, body[:200].decode(errors="replace"))
+                    return _EMPTY_ANALYSIS
+                
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = orjson.loads(data).get("choices")
+                    if not choices:
+                        continue
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta and scanner.feed(delta):
+                        break
             
             elapsed = time.time() - start_time
-            logger.info(f"✅ Получен ответ от Perplexity ({elapsed:.2f}с)")
+            logger.info("✅ Получен ответ от Perplexity (%.2fс)", elapsed)
             
-            if response.status_code != 200:
-                error_msg = f"API ошибка {response.status_code}: {response.text[:200]}"
-                logger.error(f"❌ {error_msg}")
-                return CompetitorAnalysis()
-            
-            # Парсим ответ
-            data = response.json()
-            
-            if "choices" not in data or len(data["choices"]) == 0:
+            if not scanner.parts:
                 logger.error("❌ Неожиданный формат ответа от API")
-                return CompetitorAnalysis()
+                return _EMPTY_ANALYSIS
             
-            analysis_text = data["choices"][0]["message"]["content"]
-            logger.info(f"📝 Получен анализ ({len(analysis_text)} символов)")
-            logger.debug(f"Контент: {analysis_text[:300]}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                analysis_text = scanner.text()
+                logger.debug("📝 Получен анализ (%d символов)", len(analysis_text))
+                logger.debug("Контент: %s...", analysis_text[:300])
             
             # Парсим JSON из ответа
-            analysis_data = self._parse_json_response(analysis_text)
+            analysis_data = self._load_json(scanner.result())
             
             if not analysis_data:
                 logger.warning("⚠️  Не удалось распарсить JSON, возвращаем пустой результат")
-                return CompetitorAnalysis()
+                return _EMPTY_ANALYSIS
             
             # Создаём объект анализа
             result = CompetitorAnalysis(
@@ -187,24 +313,21 @@ class PerplexityService:
                 summary=analysis_data.get("summary", "")
             )
             
-            logger.info(f"✅ Анализ завершен успешно")
-            logger.info(f"   📊 Найдено: {len(result.strengths)} сильные, "
-                       f"{len(result.weaknesses)} слабые, "
-                       f"{len(result.recommendations)} рекомендаций")
-            logger.info("=" * 60)
+            logger.info("✅ Анализ завершен: %d сильные, %d слабые, %d рекомендаций",
+                        len(result.strengths), len(result.weaknesses), len(result.recommendations))
             
             return result
             
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("❌ Timeout: Perplexity не ответил за 30 сек")
-            return CompetitorAnalysis()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"❌ Ошибка запроса: {str(e)}")
-            return CompetitorAnalysis()
+            return _EMPTY_ANALYSIS
+        except httpx.HTTPError as e:
+            logger.error("❌ Ошибка запроса: %s", e)
+            return _EMPTY_ANALYSIS
         except Exception as e:
-            logger.error(f"❌ Неожиданная ошибка: {str(e)}")
+            logger.error("❌ Неожиданная ошибка: %s", e)
             logger.exception("Полный трейбек:")
-            return CompetitorAnalysis()
+            return _EMPTY_ANALYSIS
     
     async def ask_question(self, question: str) -> str:
         """
@@ -216,14 +339,10 @@ class PerplexityService:
         Returns:
             str: Ответ от Perplexity
         """
-        logger.debug(f"❓ Вопрос: {question[:100]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("❓ Вопрос: %s...", question[:100])
         
         try:
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            }
-            
             payload = {
                 "model": self.model,
                 "messages": [
@@ -237,27 +356,29 @@ class PerplexityService:
                 "top_p": 0.9,
             }
             
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                verify=False,
-                timeout=30
-            )
+            response = await _CLIENT.post(self.base_url, content=orjson.dumps(payload))
             
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 answer = data["choices"][0]["message"]["content"]
-                logger.debug(f"✅ Получен ответ ({len(answer)} символов)")
+                logger.debug("✅ Получен ответ (%d символов)", len(answer))
                 return answer
             else:
-                logger.error(f"❌ API ошибка {response.status_code}")
+                logger.error("❌ API ошибка %d", response.status_code)
                 return f"Ошибка API: {response.status_code}"
                 
         except Exception as e:
-            logger.error(f"❌ Ошибка: {str(e)}")
+            logger.error("❌ Ошибка: %s", e)
             return f"Ошибка: {str(e)}"
 
 
+async def aclose_client():
+    """
+    Закрывает общий HTTP клиент всех экземпляров PerplexityService.
+    Вызывать один раз из shutdown-хука приложения, которое владеет сервисом
+    """
+    await _CLIENT.aclose()
+
+
 # Экземпляр сервиса для использования в приложении
 perplexity_service = PerplexityService()
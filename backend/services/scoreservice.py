@@ -1,9 +1,19 @@
+import heapq
 import logging
-from typing import Dict, Optional
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
 from backend.models.schemas import CompetitorAnalysis, ImageAnalysis
 
 logger = logging.getLogger("competitionmonitor.scorer")
 
+# Упакованный словарь ключевых слов: (пары (ключ, вес), сумма весов)
+KeywordTable = Tuple[Tuple[Tuple[str, float], ...], float]
+
+
+def _overall_score(item) -> float:
+    """Ключ сортировки для пар (имя, скор)"""
+    return item[1].get("overall_score", 0)
+
 
 class DesignToolsScoringService:
     """
@@ -52,51 +62,60 @@ class DesignToolsScoringService:
         logger.info(f"   🎬 Ключевые слова для анимаций: {len(self.ANIMATION_KEYWORDS)}")
         logger.info(f"   ⚙️  Ключевые слова для функций: {len(self.FEATURE_KEYWORDS)}")
         logger.info(f"   👥 Ключевые слова для UX: {len(self.UX_KEYWORDS)}")
+        
+        # Словари не меняются - упаковываем в (пары, нормализатор) один раз, а не на каждый вызов
+        self._design_table = self._pack(self.DESIGN_KEYWORDS)
+        self._animation_table = self._pack(self.ANIMATION_KEYWORDS)
+        self._feature_table = self._pack(self.FEATURE_KEYWORDS)
+        self._ux_table = self._pack(self.UX_KEYWORDS)
+    
+    @staticmethod
+    def _pack(keywords: Dict[str, float]) -> KeywordTable:
+        """Упаковывает словарь ключевых слов в кортеж пар и сумму весов"""
+        # Текст сравнивается в нижнем регистре - ключ с заглавными никогда бы не совпал
+        for keyword in keywords:
+            if keyword != keyword.lower():
+                raise ValueError(f"Ключевое слово должно быть в нижнем регистре: {keyword!r}")
+        return tuple(keywords.items()), sum(keywords.values())
     
-    def _score_text(self, text: str, keywords: Dict[str, float]) -> float:
+    def _score_text(self, text_lower: str, table: KeywordTable) -> float:
         """
         Оценивает текст по наличию ключевых слов
         
         Args:
-            text: Текст для анализа
-            keywords: Словарь ключевых слов с весами
+            text_lower: Текст для анализа, уже приведённый к нижнему регистру
+            table: Упакованный словарь ключевых слов (см. _pack)
             
         Returns:
             float: Оценка 0-10
         """
-        if not text:
+        if not text_lower:
             return 0.0
         
-        text_lower = text.lower()
-        score = 0.0
+        items, max_score = table
         
-        for keyword, weight in keywords.items():
-            if keyword in text_lower:
-                score += weight
+        score = sum(weight for keyword, weight in items if keyword in text_lower)
         
         # Нормализуем к 0-10
-        max_score = sum(keywords.values())
         normalized = (score / max_score * 10) if max_score > 0 else 0
         
         return min(10.0, normalized)
     
-    def _analyze_strengths(self, strengths: list) -> Dict[str, float]:
+    def _analyze_strengths(self, strengths_lower: str) -> Dict[str, float]:
         """
         Анализирует сильные стороны для выявления специфичных метрик
         
         Args:
-            strengths: Список сильных сторон
+            strengths_lower: Сильные стороны одной строкой в нижнем регистре
             
         Returns:
             dict: Выявленные метрики
         """
-        combined_text = " ".join(strengths).lower()
-        
         return {
-            "design_focus": self._score_text(combined_text, self.DESIGN_KEYWORDS),
-            "animation_focus": self._score_text(combined_text, self.ANIMATION_KEYWORDS),
-            "ai_features": self._score_text(combined_text, self.FEATURE_KEYWORDS),
-            "ux_emphasis": self._score_text(combined_text, self.UX_KEYWORDS),
+            "design_focus": self._score_text(strengths_lower, self._design_table),
+            "animation_focus": self._score_text(strengths_lower, self._animation_table),
+            "ai_features": self._score_text(strengths_lower, self._feature_table),
+            "ux_emphasis": self._score_text(strengths_lower, self._ux_table),
         }
     
     def score_competitor_text(self, analysis: CompetitorAnalysis) -> Dict:
@@ -107,26 +126,28 @@ class DesignToolsScoringService:
             analysis: Объект анализа от Perplexity
             
         Returns:
-            dict: Объект со скорами
+            dict: Объект со скорами (внутри считаем без округления, округляем только на выходе)
         """
         logger.info("📊 Скоринг текстового анализа...")
         
-        # Объединяем все текстовые данные
-        combined_text = " ".join([
-            " ".join(analysis.strengths),
-            " ".join(analysis.weaknesses),
-            " ".join(analysis.unique_offers),
-            analysis.summary
+        # Склеиваем и приводим к нижнему регистру один раз за вызов
+        strengths_lower = " ".join(analysis.strengths).lower()
+        weaknesses_lower = " ".join(analysis.weaknesses).lower()
+        combined_lower = " ".join([
+            strengths_lower,
+            weaknesses_lower,
+            " ".join(analysis.unique_offers).lower(),
+            analysis.summary.lower()
         ])
         
         # Рассчитываем основные метрики
-        design_score = self._score_text(combined_text, self.DESIGN_KEYWORDS)
-        animation_potential = self._score_text(combined_text, self.ANIMATION_KEYWORDS)
-        feature_richness = self._score_text(combined_text, self.FEATURE_KEYWORDS)
-        ux_rating = self._score_text(combined_text, self.UX_KEYWORDS)
+        design_score = self._score_text(combined_lower, self._design_table)
+        animation_potential = self._score_text(combined_lower, self._animation_table)
+        feature_richness = self._score_text(combined_lower, self._feature_table)
+        ux_rating = self._score_text(combined_lower, self._ux_table)
         
         # Анализируем сильные стороны
-        strengths_analysis = self._analyze_strengths(analysis.strengths)
+        strengths_analysis = self._analyze_strengths(strengths_lower)
         
         # Определяем уровень угрозы
         overall_score = (design_score + animation_potential + feature_richness + ux_rating) / 4
@@ -147,13 +168,35 @@ class DesignToolsScoringService:
             "strengths_analysis": {k: round(v, 2) for k, v in strengths_analysis.items()},
             "recommendations": self._generate_recommendations(
                 design_score, animation_potential, feature_richness, ux_rating,
-                analysis.weaknesses
+                weaknesses_lower
             )
         }
         
-        logger.info(f"✅ Скоринг завершен: threat_level={threat_level}, overall={overall_score:.2f}")
+        logger.info("✅ Скоринг завершен: threat_level=%s, overall=%.2f", threat_level, overall_score)
         return result
     
+    def score_competitor_texts(self, analyses: List[CompetitorAnalysis]) -> List[Dict]:
+        """
+        Скорит пачку текстовых анализов за один вызов
+        
+        Args:
+            analyses: Список объектов анализа от Perplexity
+        
+        Returns:
+            list: Скоры в том же порядке; для упавших элементов - пустой dict
+        """
+        logger.info("📊 Пакетный скоринг %d анализов...", len(analyses))
+        
+        results = []
+        for analysis in analyses:
+            try:
+                results.append(self.score_competitor_text(analysis))
+            except Exception as e:
+                logger.error("❌ Ошибка скоринга: %s", e)
+                results.append({})
+        
+        return results
+    
     def score_competitor_image(self, image_analysis: ImageAnalysis) -> Dict:
         """
         Скорит анализ изображения конкурента
@@ -171,7 +214,7 @@ class DesignToolsScoringService:
         
         # Анализируем маркетинговые insights для потенциала
         combined_text = " ".join(image_analysis.marketing_insights).lower()
-        animation_potential = self._score_text(combined_text, self.ANIMATION_KEYWORDS)
+        animation_potential = self._score_text(combined_text, self._animation_table)
         
         result = {
             "design_score": design_score,
@@ -182,17 +225,17 @@ class DesignToolsScoringService:
             "recommendations": image_analysis.recommendations
         }
         
-        logger.info(f"✅ Скоринг изображения: design={design_score}, animation={animation_potential:.2f}")
+        logger.info("✅ Скоринг изображения: design=%s, animation=%.2f", design_score, animation_potential)
         return result
     
     def _generate_recommendations(self, design: float, animation: float, 
-                                 features: float, ux: float, weaknesses: list) -> list:
+                                 features: float, ux: float, weaknesses_lower: str) -> list:
         """
         Генерирует специфичные рекомендации на основе метрик
         
         Args:
             design, animation, features, ux: Оценки метрик
-            weaknesses: Список слабых сторон
+            weaknesses_lower: Слабые стороны одной строкой в нижнем регистре
             
         Returns:
             list: Рекомендации
@@ -211,49 +254,62 @@ class DesignToolsScoringService:
         if ux < 5:
             recommendations.append("👥 Улучшить доступность и эргономику интерфейса")
         
-        if "цена" in " ".join(weaknesses).lower():
+        if "цена" in weaknesses_lower:
             recommendations.append("💰 Конкурировать по качеству, а не по цене")
         
-        if "ai" not in " ".join(weaknesses).lower() and features > 6:
+        if "ai" not in weaknesses_lower and features > 6:
             recommendations.append("🤖 Конкурент активно использует AI - это угроза")
         
         return recommendations
     
-    def compare_competitors(self, scores: Dict[str, Dict]) -> Dict:
+    def compare_competitors(self, scores: Dict[str, Dict], n: Optional[int] = None) -> Dict:
         """
         Сравнивает несколько конкурентов
         
         Args:
             scores: Словарь {имя_конкурента: объект_скора}
+            n: Сколько лучших оставить в рейтинге (None - все)
             
         Returns:
             dict: Сравнительный анализ
         """
-        logger.info(f"📊 Сравнение {len(scores)} конкурентов...")
+        logger.info("📊 Сравнение %d конкурентов...", len(scores))
+        
+        # Для top-N хватает кучи: O(k log N) вместо полной сортировки
+        if n is not None:
+            competitors_sorted = heapq.nlargest(n, scores.items(), key=_overall_score)
+        else:
+            competitors_sorted = sorted(scores.items(), key=_overall_score, reverse=True)
         
-        competitors_sorted = sorted(
-            scores.items(),
-            key=lambda x: x[1].get("overall_score", 0),
-            reverse=True
-        )
+        # Уровни угрозы считаем за один проход вместо трёх
+        threat_counts = Counter(s.get("overall_threat_level") for s in scores.values())
         
         return {
             "ranking": [{"name": name, "score": score["overall_score"]} 
                        for name, score in competitors_sorted],
             "threat_levels": {
-                "high": sum(1 for _, s in scores.items() if s.get("overall_threat_level") == "high"),
-                "medium": sum(1 for _, s in scores.items() if s.get("overall_threat_level") == "medium"),
-                "low": sum(1 for _, s in scores.items() if s.get("overall_threat_level") == "low"),
+                "high": threat_counts["high"],
+                "medium": threat_counts["medium"],
+                "low": threat_counts["low"],
             },
             "market_analysis": self._analyze_market(scores)
         }
     
     def _analyze_market(self, scores: Dict[str, Dict]) -> Dict:
         """Анализирует общее состояние рынка"""
-        avg_design = sum(s.get("design_score", 0) for s in scores.values()) / len(scores) if scores else 0
-        avg_animation = sum(s.get("animation_potential", 0) for s in scores.values()) / len(scores) if scores else 0
-        avg_features = sum(s.get("feature_richness", 0) for s in scores.values()) / len(scores) if scores else 0
-        avg_ux = sum(s.get("ux_rating", 0) for s in scores.values()) / len(scores) if scores else 0
+        # Все четыре суммы - за один проход по скорам
+        sum_design = sum_animation = sum_features = sum_ux = 0.0
+        for s in scores.values():
+            sum_design += s.get("design_score", 0)
+            sum_animation += s.get("animation_potential", 0)
+            sum_features += s.get("feature_richness", 0)
+            sum_ux += s.get("ux_rating", 0)
+        
+        n = len(scores) or 1
+        avg_design = sum_design / n
+        avg_animation = sum_animation / n
+        avg_features = sum_features / n
+        avg_ux = sum_ux / n
         
         return {
             "avg_design_score": round(avg_design, 2),
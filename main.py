@@ -1,11 +1,16 @@
 ﻿import os
 import sys
+import asyncio
 import logging
+import threading
+import time
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
+import orjson
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 import uvicorn
 from pydantic import BaseModel
 from reportlab.lib.pagesizes import letter
@@ -59,26 +64,42 @@ class ImageAnalysis(BaseModel):
 
 import sqlite3
 
+# Одно соединение на процесс вместо connect/close на каждый запрос
+DB = sqlite3.connect(DB_PATH, check_same_thread=False)
+DB.execute("PRAGMA journal_mode=WAL")
+DB.execute("PRAGMA synchronous=NORMAL")
+DB_LOCK = threading.Lock()
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS analyses (
-            id INTEGER PRIMARY KEY,
-            text TEXT,
-            image BLOB,
-            result TEXT,
-            scoring TEXT,
-            created_at TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with DB_LOCK, DB:
+        DB.execute('''
+            CREATE TABLE IF NOT EXISTS analyses (
+                id INTEGER PRIMARY KEY,
+                text TEXT,
+                image BLOB,
+                result TEXT,
+                scoring TEXT,
+                created_at TIMESTAMP
+            )
+        ''')
+        DB.execute('CREATE INDEX IF NOT EXISTS idx_analyses_created_at ON analyses(created_at DESC)')
     logger.info("✅ База данных инициализирована")
 
+def _fetchone(sql: str, params: tuple = ()):
+    with DB_LOCK:
+        return DB.execute(sql, params).fetchone()
+
+def _fetchall(sql: str, params: tuple = ()):
+    with DB_LOCK:
+        return DB.execute(sql, params).fetchall()
+
 init_db()
 
-app = FastAPI(title="CompetitionMonitor API", version="1.0")
+app = FastAPI(title="CompetitionMonitor API", version="1.0", default_response_class=ORJSONResponse)
+
+@app.on_event("shutdown")
+def close_db():
+    DB.close()
 
 app.add_middleware(
     CORSMiddleware,
@@ -88,9 +109,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Ответы / и /health не меняются за время жизни процесса - сериализуем один раз
+_ROOT_BODY = orjson.dumps({"status": "✅ CompetitionMonitor работает", "scoring": "✅ Включен" if SCORING_ENABLED else "❌ Отключен"})
+_HEALTH_BODY = orjson.dumps({"status": "✅ API работает", "db": "✅ БД доступна", "scoring": "✅ Включен" if SCORING_ENABLED else "❌ Отключен"})
+
+# Короткий кэш /history: (момент истечения, готовое тело ответа)
+HISTORY_TTL = 2.0
+_history_cache = (0.0, b"")
+
 @app.get("/")
 async def root():
-    return {"status": "✅ CompetitionMonitor работает", "scoring": "✅ Включен" if SCORING_ENABLED else "❌ Отключен"}
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.post("/analyzetext")
 async def analyze_text(text: str):
@@ -116,13 +145,18 @@ async def analyze_text_scored(text: str):
 
 @app.get("/history")
 async def get_history():
+    global _history_cache
+    now = time.monotonic()
+    if now < _history_cache[0]:
+        return Response(content=_history_cache[1], media_type="application/json")
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM analyses ORDER BY created_at DESC LIMIT 10')
-        results = cursor.fetchall()
-        conn.close()
-        return {"history": results}
+        # image (BLOB) в списке не нужен - выбираем только скалярные колонки
+        results = await asyncio.to_thread(
+            _fetchall, 'SELECT id, text, result, scoring, created_at FROM analyses ORDER BY created_at DESC LIMIT 10'
+        )
+        body = orjson.dumps({"history": results})
+        _history_cache = (now + HISTORY_TTL, body)
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         logger.error(f"❌ Ошибка: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -130,11 +164,9 @@ async def get_history():
 @app.get("/analysis/{id}")
 async def get_analysis(id: int):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM analyses WHERE id = ?', (id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = await asyncio.to_thread(
+            _fetchone, 'SELECT id, text, result, scoring, created_at FROM analyses WHERE id = ?', (id,)
+        )
         if result:
             return {"analysis": result}
         raise HTTPException(status_code=404, detail="Анализ не найден")
@@ -142,23 +174,29 @@ async def get_analysis(id: int):
         logger.error(f"❌ Ошибка: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _build_pdf(id: int) -> bytes:
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=letter)
+    c.drawString(100, 750, f"Анализ #{id}")
+    c.drawString(100, 730, f"Дата: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    c.save()
+    return buf.getvalue()
+
 @app.post("/export-pdf/{id}")
 async def export_pdf(id: int):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM analyses WHERE id = ?', (id,))
-        result = cursor.fetchone()
-        conn.close()
-        if not result:
+        # PDF использует только id - проверяем существование, не читая строку целиком
+        exists = await asyncio.to_thread(_fetchone, 'SELECT 1 FROM analyses WHERE id = ? LIMIT 1', (id,))
+        if not exists:
             raise HTTPException(status_code=404, detail="Анализ не найден")
-        pdf_filename = f"analysis_{id}.pdf"
-        c = canvas.Canvas(pdf_filename, pagesize=letter)
-        c.drawString(100, 750, f"Анализ #{id}")
-        c.drawString(100, 730, f"Дата: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        c.save()
-        logger.info(f"📄 PDF создан: {pdf_filename}")
-        return {"pdf": pdf_filename}
+        # reportlab блокирует - рисуем в пуле потоков, в память, без записи на диск
+        pdf = await asyncio.to_thread(_build_pdf, id)
+        logger.info(f"📄 PDF сформирован в памяти для анализа {id}")
+        return Response(
+            content=pdf,
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"attachment; filename=analysis_{id}.pdf"}
+        )
     except Exception as e:
         logger.error(f"❌ Ошибка: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -173,7 +211,7 @@ async def compare_competitors():
 
 @app.get("/health")
 async def health():
-    return {"status": "✅ API работает", "db": "✅ БД доступна", "scoring": "✅ Включен" if SCORING_ENABLED else "❌ Отключен"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 if __name__ == "__main__":
     print(f"✅ API ключ: {API_KEY[:20]}...", file=sys.stdout, flush=True)
@@ -185,4 +223,8 @@ if __name__ == "__main__":
     print(f"📍 SCORING_ENABLED = {SCORING_ENABLED}", file=sys.stdout, flush=True)
     print(f"📍 scorer = {scorer}", file=sys.stdout, flush=True)
     
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    # uvloop и httptools uvicorn подхватывает сам (loop/http="auto"), если они установлены.
+    # Несколько воркеров требуют строку импорта вместо объекта app
+    workers = int(os.getenv("WEB_CONCURRENCY") or os.cpu_count() or 1)
+    print(f"👷 Воркеров: {workers}", file=sys.stdout, flush=True)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, log_level="info", workers=workers)
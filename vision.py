@@ -1,18 +1,45 @@
 from fastapi import FastAPI, UploadFile, File, Form
+from fastapi.responses import ORJSONResponse
 from openai import OpenAI
 from PIL import Image
-import io, base64, os, logging
+import io, base64, os, logging, asyncio
+import httpx
 from dotenv import load_dotenv
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="ДЗ Модуль 4 - Мультимодалка")
+app = FastAPI(title="ДЗ Модуль 4 - Мультимодалка", default_response_class=ORJSONResponse)
+
+# Форматы, которые модель принимает без перекодирования
+PASSTHROUGH_FORMATS = {"PNG", "JPEG", "WEBP"}
+# Длинная сторона, до которой уменьшаем большие изображения перед отправкой
+MAX_IMAGE_SIDE = 1024
+
+
+def encode_image(contents: bytes) -> tuple[str, str]:
+    """Возвращает (mime, base64); большие и неподдерживаемые изображения ужимаются в JPEG"""
+    # Image.open читает только заголовок - пиксели не декодируются
+    image = Image.open(io.BytesIO(contents))
+    if image.format in PASSTHROUGH_FORMATS and max(image.size) <= MAX_IMAGE_SIDE:
+        return Image.MIME[image.format], base64.b64encode(contents).decode()
+
+    # JPEG декодируется сразу в уменьшенном масштабе
+    image.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=85, optimize=True)
+    return "image/jpeg", base64.b64encode(buffered.getvalue()).decode()
 
 client = OpenAI(
     api_key=os.getenv("PERPLEXITY_API_KEY"),
-    base_url="https://api.perplexity.ai"
+    base_url="https://api.perplexity.ai",
+    http_client=httpx.Client(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_keepalive_connections=10)
+    )
 )
 
 @app.get("/")
@@ -23,18 +50,17 @@ async def root():
 async def analyze_image(file: UploadFile = File(...), prompt: str = Form("Опиши подробно")):
     try:
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_b64 = base64.b64encode(buffered.getvalue()).decode()
+        # Декодирование и сжатие нагружают CPU - уводим с event loop
+        mime, img_b64 = await asyncio.to_thread(encode_image, contents)
         
-        response = client.chat.completions.create(
+        response = await asyncio.to_thread(
+            client.chat.completions.create,
             model="sonar-pro",
             messages=[{
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_b64}"}}
+                    {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{img_b64}"}}
                 ]
             }],
             max_tokens=1000